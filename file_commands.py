@@ -33,14 +33,14 @@ async def handle_files_command(user_id, chat_id, args=None):
         files_by_type[file_type].append(file)
     
     # Generate response
-    reply = "🗂 *Your Files*:\n\n"
+    parts = ["🗂 *Your Files*:\n\n"]
     
     # Process each file type
     for file_type, type_files in files_by_type.items():
         # Get emoji for file type
         type_emoji = "📄" if file_type == "pdf" or file_type == "documents" else "🖼" if file_type == "images" else "📁"
         
-        reply += f"*{type_emoji} {file_type.capitalize()}*\n"
+        parts.append(f"*{type_emoji} {file_type.capitalize()}*\n")
         
         # List files of this type
         for i, file in enumerate(type_files, 1):
@@ -61,12 +61,12 @@ async def handle_files_command(user_id, chat_id, args=None):
             if file.get("timestamp"):
                 date_str = f" ({file['timestamp']})"
             
-            reply += f"{i}. [{file_name}]({file_url}){date_str}{preview}\n"
+            parts.append(f"{i}. [{file_name}]({file_url}){date_str}{preview}\n")
         
-        reply += "\n"
+        parts.append("\n")
     
     # Add help text
-    reply += "\n*To reference a file, ask about it by name or content.*\n"
-    reply += "For example: \"What does the marketing PDF say about customers?\""
+    parts.append("\n*To reference a file, ask about it by name or content.*\n")
+    parts.append("For example: \"What does the marketing PDF say about customers?\"")
     
-    await send_message(chat_id, reply)
+    await send_message(chat_id, "".join(parts))
@@ -31,17 +31,10 @@ def get_firebase_app():
                 })
             # Try with environment variable
             elif os.environ.get("FIREBASE_SERVICE_ACCOUNT"):
-                import tempfile
-                fd, path = tempfile.mkstemp()
-                with os.fdopen(fd, 'w') as tmp:
-                    tmp.write(os.environ.get("FIREBASE_SERVICE_ACCOUNT"))
-                cred = credentials.Certificate(path)
-                app = firebase_admin.initialize_app(cred, {
+                cred = credentials.Certificate(json.loads(os.environ["FIREBASE_SERVICE_ACCOUNT"]))
+                return firebase_admin.initialize_app(cred, {
                     'storageBucket': os.environ.get("FIREBASE_STORAGE_BUCKET", "telemind-assistant.appspot.com")
                 })
-                # Clean up
-                os.unlink(path)
-                return app
             else:
                 # Last resort - try default credentials
                 return firebase_admin.initialize_app(options={
@@ -225,11 +218,15 @@ def extract_text_preview(pdf_path, max_chars=500):
     try:
         with open(pdf_path, 'rb') as f:
             reader = PyPDF2.PdfReader(f)
-            text = ""
+            parts = []
+            length = 0
             for page in reader.pages:
-                if len(text) >= max_chars:
+                if length >= max_chars:
                     break
-                text += page.extract_text() or ""
+                page_text = page.extract_text() or ""
+                parts.append(page_text)
+                length += len(page_text)
+            text = "".join(parts)
             
             # Limit to max_chars
             if len(text) > max_chars:
@@ -269,12 +266,12 @@ def get_user_files(user_id, file_type=None):
         if not db:
             return []
             
-        # Get user document
-        user_doc = db.collection('users').document(user_id).get()
+        # Get only the files field of the user document
+        user_doc = db.collection('users').document(user_id).get(field_paths=['files'])
         if not user_doc.exists:
             return []
             
-        user_data = user_doc.to_dict()
+        user_data = user_doc.to_dict() or {}
         all_files = user_data.get('files', [])
         
         # Filter by type if specified
@@ -1,16 +1,22 @@
 import os
 import re
-import json
 import time
 import asyncio
+import functools
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Union, Any
+from typing import Deque, Dict, List, Optional, Union, Any
 
 # --- Core Dependencies ---
 from fastapi import FastAPI, Request, BackgroundTasks, Query, Depends
+from fastapi.responses import ORJSONResponse
 import httpx
-from groq import Groq
-from pydantic import BaseModel
+import orjson
+import aiofiles
+from groq import AsyncGroq
 
 # --- Firebase Setup ---
 import firebase_admin
@@ -26,37 +32,125 @@ try:
     import pytesseract  # For OCR
 except ImportError:
     print("pytesseract not installed. OCR functionality will be limited.")
+else:
+    # Register a custom Tesseract binary once instead of on every OCR call
+    _tesseract_cmd = os.getenv("TESSERACT_PATH")
+    if _tesseract_cmd:
+        pytesseract.pytesseract.tesseract_cmd = _tesseract_cmd
+try:
+    # Preferred image OCR engine when installed (paddleocr<3, see requirements.txt);
+    # loaded once at startup
+    from paddleocr import PaddleOCR
+    paddle_ocr = PaddleOCR(use_angle_cls=True, lang="en", show_log=False)
+except ImportError:
+    paddle_ocr = None
+except Exception as e:
+    # e.g. paddleocr 3.x, whose constructor and ocr() arguments differ
+    print(f"PaddleOCR could not be initialised ({e}). Falling back to pytesseract.")
+    paddle_ocr = None
+# The Paddle predictor isn't thread-safe, and OCR runs in to_thread workers
+paddle_ocr_lock = threading.Lock()
 
 # --- Logging helper ---
+# Formatted timestamp memoized per second: (epoch_second, formatted)
+_last_log_ts = (0, "")
+
 def log(msg, *args, level="INFO"):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{level}] {timestamp} | {msg}", *args, flush=True)
+    global _last_log_ts
+    now = int(time.time())
+    second, timestamp = _last_log_ts
+    if now != second:
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))
+        _last_log_ts = (now, timestamp)
+    line = f"[{level}] {timestamp} | {msg}"
+    if args:
+        line = " ".join([line, *map(str, args)])
+    print(line, flush=True)
     
 # --- OCR Helper ---
+# OCR results keyed by SHA-256 of the image bytes, backed by the Firestore
+# "ocr_cache" collection so repeated uploads skip Tesseract
+OCR_CACHE_SIZE = 1024
+ocr_cache: "OrderedDict[str, str]" = OrderedDict()
+
+def _file_sha256(file_path: str) -> str:
+    """Hash a file's contents"""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def _ocr_image(image_path: str) -> str:
+    """Run OCR on an image file with PaddleOCR, falling back to pytesseract (blocking)"""
+    if paddle_ocr is not None:
+        with paddle_ocr_lock:
+            result = paddle_ocr.ocr(image_path, cls=True)
+        return "\n".join(line[1][0] for block in result if block for line in block)
+    return pytesseract.image_to_string(Image.open(image_path))
+
 async def extract_text_from_image(image_path: str) -> str:
     """Extract text from an image using OCR"""
     try:
-        # Check if pytesseract is available
-        if 'pytesseract' not in globals():
-            log("OCR skipped - pytesseract not installed", level="WARNING")
+        # Check if an OCR engine is available
+        if paddle_ocr is None and 'pytesseract' not in globals():
+            log("OCR skipped - neither paddleocr nor pytesseract installed", level="WARNING")
             return ""
-            
-        # Process with OCR
-        loop = asyncio.get_event_loop()
         
-        # Check if a custom Tesseract path is specified
-        tesseract_cmd = os.getenv("TESSERACT_PATH")
-        if tesseract_cmd:
-            pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
-            
-        # Process image with pytesseract
-        img = Image.open(image_path)
-        result = await loop.run_in_executor(None, lambda: pytesseract.image_to_string(img))
+        # Return cached text if this exact image was seen before
+        image_hash = await asyncio.to_thread(_file_sha256, image_path)
+        if image_hash in ocr_cache:
+            ocr_cache.move_to_end(image_hash)
+            return ocr_cache[image_hash]
+        # The Firestore cache is optional - OCR still runs if it's unavailable
+        cache_ref = db.collection("ocr_cache").document(image_hash)
+        result = None
+        try:
+            cached = await run_firestore(cache_ref.get)
+            if cached.exists:
+                result = cached.to_dict().get("text", "")
+        except Exception as e:
+            log(f"Error reading OCR cache: {e}", level="WARNING")
+        
+        if result is None:
+            result = await asyncio.to_thread(_ocr_image, image_path)
+            try:
+                await run_firestore(cache_ref.set, {"text": result, "created_at": time.time()})
+            except Exception as e:
+                log(f"Error writing OCR cache: {e}", level="WARNING")
+        
+        ocr_cache[image_hash] = result
+        if len(ocr_cache) > OCR_CACHE_SIZE:
+            ocr_cache.popitem(last=False)
         return result
     except Exception as e:
         log(f"Error extracting text from image: {e}", level="ERROR")
         return ""
 
+# Rasterisation settings for OCR of image-only PDFs: 150 DPI grayscale pages
+# binarised at a fixed threshold keep Tesseract's input small
+PDF_OCR_DPI = 150
+PDF_OCR_THRESHOLD = 180
+
+def _ocr_pdf(doc, max_pages: int, max_chars: int) -> tuple:
+    """OCR pages of an open PyMuPDF document until max_pages or max_chars is reached (blocking)
+    
+    Returns (text, processed_pages), with text cut to max_chars.
+    """
+    page_texts = []
+    text_length = 0
+    for page_num in range(max_pages):
+        if text_length >= max_chars:
+            break
+        pix = doc[page_num].get_pixmap(dpi=PDF_OCR_DPI, colorspace=fitz.csGRAY)
+        img = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+        img = img.point(lambda p: 255 if p > PDF_OCR_THRESHOLD else 0, mode="1")
+        page_text = pytesseract.image_to_string(img).strip()
+        # Count the "\n\n" separator joined in before this page
+        text_length += len(page_text) + (2 if page_texts else 0)
+        page_texts.append(page_text)
+    return "\n\n".join(page_texts)[:max_chars], len(page_texts)
+
 # --- Environment Variables ---
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -67,26 +161,81 @@ if not TELEGRAM_BOT_TOKEN:
 
 # --- Initialize clients ---
 # Groq client for LLM
-groq_client = Groq(api_key=GROQ_API_KEY)
+groq_client = AsyncGroq(api_key=GROQ_API_KEY)
+GROQ_MODEL = "llama3-8b-8192"
 API_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
+# Shared Telegram client so every call reuses pooled keep-alive connections
+telegram_http = httpx.AsyncClient(
+    base_url=API_URL,
+    timeout=10,
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=100)
+)
+
+# Read size when streaming Telegram file downloads to disk
+DOWNLOAD_CHUNK_SIZE = 65536
+
+# Minimum seconds between editMessageText calls while streaming a reply
+STREAM_EDIT_INTERVAL = 1.0
+
+# Characters that can make Telegram's Markdown rendering differ from the plain text
+MARKDOWN_CHARS = frozenset("*_`[")
 
 # --- Message processing helpers ---
-async def send_message(chat_id: int, text: str):
-    """Send message to user via Telegram"""
+async def telegram_post(method: str, payload: dict) -> dict:
+    """Call a Telegram Bot API method, encoding and decoding JSON with orjson"""
+    response = await telegram_http.post(
+        f"/{method}",
+        content=orjson.dumps(payload),
+        headers={"Content-Type": "application/json"}
+    )
+    return orjson.loads(response.content)
+
+async def send_message(chat_id: int, text: str, parse_mode: Optional[str] = "Markdown") -> Optional[int]:
+    """Send message to user via Telegram and return its message_id"""
+    payload = {"chat_id": chat_id, "text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(f"{API_URL}/sendMessage", json={
-                "chat_id": chat_id,
-                "text": text,
-                "parse_mode": "Markdown"
-            })
-            
-            # Check if the response was successful
-            response_data = response.json()
-            if not response_data.get("ok"):
-                log(f"Telegram API error: {response_data}", level="ERROR")
+        response_data = await telegram_post("sendMessage", payload)
+        
+        # Check if the response was successful
+        if not response_data.get("ok"):
+            log(f"Telegram API error: {response_data}", level="ERROR")
+            return None
+        return response_data["result"]["message_id"]
     except Exception as e:
         log(f"Error sending message to Telegram: {e}", level="ERROR")
+        return None
+
+async def edit_message(chat_id: int, message_id: int, text: str, parse_mode: Optional[str] = "Markdown") -> bool:
+    """Replace the text of a message previously sent to the user, returning whether it succeeded"""
+    payload = {"chat_id": chat_id, "message_id": message_id, "text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    try:
+        response_data = await telegram_post("editMessageText", payload)
+        
+        if not response_data.get("ok"):
+            # Editing to identical text is rejected, but the message already shows it
+            if "message is not modified" in response_data.get("description", ""):
+                return True
+            log(f"Telegram API error: {response_data}", level="ERROR")
+            return False
+        return True
+    except Exception as e:
+        log(f"Error editing Telegram message: {e}", level="ERROR")
+        return False
+
+async def send_or_edit(chat_id: int, message_id: Optional[int], text: str):
+    """Replace a status message with the final reply, or send it if there is none"""
+    # Replies may contain unbalanced Markdown (e.g. a lone _ or *), which Telegram
+    # rejects - fall back to plain text so the full reply still arrives
+    if message_id is None:
+        if await send_message(chat_id, text) is None:
+            await send_message(chat_id, text, parse_mode=None)
+    elif not await edit_message(chat_id, message_id, text):
+        await edit_message(chat_id, message_id, text, parse_mode=None)
 
 # --- Firebase Initialization ---
 try:
@@ -97,20 +246,12 @@ try:
     log(f"Using Firebase storage bucket: {firebase_storage_bucket}")
     
     if firebase_service_account:
-        # Create temporary file with the service account JSON
-        import tempfile
-        fd, path = tempfile.mkstemp()
-        with os.fdopen(fd, 'w') as tmp:
-            tmp.write(firebase_service_account)
-        
+        # Certificate accepts the parsed service account dict directly
         log("Initializing Firebase with service account from environment variable")
-        cred = credentials.Certificate(path)
+        cred = credentials.Certificate(orjson.loads(firebase_service_account))
         firebase_admin.initialize_app(cred, {
             'storageBucket': firebase_storage_bucket
         })
-        
-        # Clean up the temporary file
-        os.remove(path)
     else:
         # If running on local development with file
         try:
@@ -137,6 +278,25 @@ except Exception as e:
 
 # Initialize Firestore and Storage
 db = firestore.client()
+# Dedicated pool for blocking Firestore RPCs so they don't queue behind OCR work
+FS_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("FIRESTORE_WORKERS", "40")), thread_name_prefix="fs")
+
+def run_firestore(func, *args, **kwargs):
+    """Run a blocking Firestore call on FS_EXECUTOR and return an awaitable"""
+    return asyncio.get_running_loop().run_in_executor(FS_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+# Array updates and document_contents inserts are buffered on the event loop
+# and committed in WriteBatches every BULK_FLUSH_INTERVAL seconds instead of
+# one RPC per write
+BULK_FLUSH_INTERVAL = 1.0
+MAX_BATCH_WRITES = 500  # Firestore's limit per WriteBatch
+# Commits a write is tried in before it is dropped; failed writes are retried
+# on the following flushes
+MAX_WRITE_ATTEMPTS = 5
+pending_writes: List[tuple] = []  # (method, doc_ref, data, kwargs, attempts)
+
+# Long-running tasks started at application startup
+background_tasks_running: List[asyncio.Task] = []
 try:
     bucket = firebase_storage.bucket()
     log(f"Firebase Storage bucket initialized: {bucket.name}")
@@ -151,38 +311,51 @@ except Exception as e:
     bucket = PlaceholderBucket()
 
 # --- FastAPI app ---
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # --- Data Models ---
-class Message(BaseModel):
-    role: str
-    content: str
-    timestamp: Optional[float] = None
-    
-    def dict(self, *args, **kwargs):
-        """Override dict method to handle Firestore timestamps"""
-        result = super().dict(*args, **kwargs)
-        # Ensure timestamp is a simple value, not a Firestore Sentinel
-        if "timestamp" in result and isinstance(result["timestamp"], object) and hasattr(result["timestamp"], "__class__") and "Sentinel" in str(result["timestamp"].__class__):
-            result["timestamp"] = time.time()
-        return result
+SYSTEM_PROMPT = """You are TeleMind, a helpful personal assistant on Telegram.
+You help users manage tasks, take notes, and handle files.
+Be friendly and concise in your responses.
+Your goal is to help users organize their lives and provide useful information."""
 
 class UserSession:
     def __init__(self, user_id: str):
         self.user_id = user_id
-        self.messages: List[Message] = []
         self.last_interaction: float = time.time()
         self.context_window = 10  # Store last 10 messages
+        # Message history as parallel columns, bounded to the context window
+        self.roles: Deque[str] = deque(maxlen=self.context_window)
+        self.contents: Deque[str] = deque(maxlen=self.context_window)
+        self.timestamps: Deque[float] = deque(maxlen=self.context_window)
+        # Groq payload kept in step with the history, system prompt always first
+        self.llm_messages: List[Dict[str, str]] = [{"role": "system", "content": SYSTEM_PROMPT}]
+    
+    def add_message(self, role: str, content: str, timestamp: Optional[float] = None):
+        """Append a message and keep only the last context_window messages"""
+        if len(self.roles) == self.context_window:
+            del self.llm_messages[1]
+        self.roles.append(role)
+        self.contents.append(content)
+        self.timestamps.append(timestamp if timestamp is not None else time.time())
+        self.llm_messages.append({"role": role, "content": content})
+    
+    def conversation(self) -> List[dict]:
+        """Message history in the form stored in Firestore"""
+        return [
+            {"role": role, "content": content, "timestamp": timestamp}
+            for role, content, timestamp in zip(self.roles, self.contents, self.timestamps)
+        ]
 
-# Active user sessions (memory)
-user_sessions: Dict[str, UserSession] = {}
+# Active user sessions (memory), kept in least-recently-used order
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "10000"))
+user_sessions: "OrderedDict[str, UserSession]" = OrderedDict()
 
 # --- Firebase helpers ---
 async def get_user_data(user_id: str) -> dict:
     """Get user data from Firestore"""
-    loop = asyncio.get_event_loop()
     doc_ref = db.collection("users").document(str(user_id))
-    doc = await loop.run_in_executor(None, doc_ref.get)
+    doc = await run_firestore(doc_ref.get)
     if not doc.exists:
         # Initialize user data
         default_data = {
@@ -192,28 +365,89 @@ async def get_user_data(user_id: str) -> dict:
             "conversation": [],
             "created_at": time.time()  # Use time.time() instead of Firestore.SERVER_TIMESTAMP
         }
-        await loop.run_in_executor(None, lambda: doc_ref.set(default_data))
+        await run_firestore(doc_ref.set, default_data)
         return default_data
     return doc.to_dict()
 
+async def get_user_field(user_id: str, field: str, default: Any = None) -> Any:
+    """Read a single field of a user's document without fetching the rest"""
+    doc_ref = db.collection("users").document(str(user_id))
+    doc = await run_firestore(doc_ref.get, field_paths=[field])
+    if not doc.exists:
+        return default
+    return (doc.to_dict() or {}).get(field, default)
+
 async def update_user_data(user_id: str, data: dict, merge: bool = True):
     """Update user data in Firestore"""
-    loop = asyncio.get_event_loop()
     doc_ref = db.collection("users").document(str(user_id))
-    await loop.run_in_executor(None, lambda: doc_ref.set(data, merge=merge))
-
-async def add_to_user_array(user_id: str, field: str, value: Any):
-    """Add an item to a user's array field"""
-    # Convert any SERVER_TIMESTAMP values to actual timestamps before storing
-    if isinstance(value, dict):
-        for k, v in list(value.items()):
-            if isinstance(v, object) and hasattr(v, "__class__") and "Sentinel" in str(v.__class__):
-                value[k] = time.time()
-    
-    loop = asyncio.get_event_loop()
+    await run_firestore(doc_ref.set, data, merge=merge)
+
+def add_to_user_array(user_id: str, field: str, value: Any):
+    """Queue an item to be added to a user's array field"""
+    # A merge-set creates the user document if needed, so no read is required first
+    doc_ref = db.collection("users").document(str(user_id))
+    pending_writes.append(("set", doc_ref, {field: firestore.ArrayUnion([value])}, {"merge": True}, 0))
+
+def queue_user_update(user_id: str, data: dict):
+    """Queue a merge of fields into a user's document"""
     doc_ref = db.collection("users").document(str(user_id))
-    await loop.run_in_executor(None, 
-                              lambda: doc_ref.update({field: firestore.ArrayUnion([value])}))
+    pending_writes.append(("set", doc_ref, data, {"merge": True}, 0))
+
+def add_document_content(user_id: str, data: dict):
+    """Queue extracted file text for the user's document_contents collection"""
+    doc_ref = db.collection("users").document(str(user_id)).collection("document_contents").document()
+    pending_writes.append(("create", doc_ref, data, {}, 0))
+
+def _commit_writes(writes: List[tuple]) -> List[tuple]:
+    """Commit writes in WriteBatches of at most MAX_BATCH_WRITES (blocking)
+    
+    A batch is all-or-nothing, so when one fails its writes are committed one
+    at a time and only the ones that still fail are returned for a retry.
+    """
+    failed = []
+    for start in range(0, len(writes), MAX_BATCH_WRITES):
+        chunk = writes[start:start + MAX_BATCH_WRITES]
+        batch = db.batch()
+        for method, doc_ref, data, kwargs, _ in chunk:
+            getattr(batch, method)(doc_ref, data, **kwargs)
+        try:
+            batch.commit()
+            continue
+        except Exception as e:
+            log(f"Error committing batch of {len(chunk)} Firestore writes, retrying individually: {e}", level="WARNING")
+        
+        for method, doc_ref, data, kwargs, attempts in chunk:
+            try:
+                getattr(doc_ref, method)(data, **kwargs)
+            except Exception as e:
+                attempts += 1
+                if attempts < MAX_WRITE_ATTEMPTS:
+                    failed.append((method, doc_ref, data, kwargs, attempts))
+                else:
+                    log(f"Dropping Firestore write to {doc_ref.path} after {attempts} attempts: {e}", level="ERROR")
+    return failed
+
+async def commit_pending_writes():
+    """Commit every write queued so far"""
+    global pending_writes
+    # Swapped on the event loop, so each write is taken by exactly one commit
+    writes, pending_writes = pending_writes, []
+    if not writes:
+        return
+    try:
+        failed = await run_firestore(_commit_writes, writes)
+    except Exception as e:
+        log(f"Error committing {len(writes)} queued Firestore writes: {e}", level="ERROR")
+        failed = writes
+    if failed:
+        # Retry ahead of newer writes so later updates to a document still win
+        pending_writes = failed + pending_writes
+
+async def flush_bulk_writes():
+    """Periodically commit queued Firestore writes"""
+    while True:
+        await asyncio.sleep(BULK_FLUSH_INTERVAL)
+        await commit_pending_writes()
 
 async def store_file(user_id: str, file_path: str, file_name: str, file_type: str) -> str:
     """Store file in Firebase Storage (if enabled) or locally with enhanced metadata"""
@@ -305,7 +539,7 @@ async def store_file(user_id: str, file_path: str, file_name: str, file_type: st
             "content_preview": content_preview if 'content_preview' in locals() else "",
             "file_hash": file_hash if 'file_hash' in locals() else ""
         }
-        await add_to_user_array(user_id, "files", file_data)
+        add_to_user_array(user_id, "files", file_data)
         
         return file_url
     except Exception as e:
@@ -314,6 +548,31 @@ async def store_file(user_id: str, file_path: str, file_name: str, file_type: st
         return ""
 
 # --- API endpoints ---
+async def warm_up_groq():
+    """Open the Groq connection pool with a one-token request"""
+    try:
+        await groq_client.chat.completions.create(
+            model=GROQ_MODEL,
+            messages=[{"role": "user", "content": "ping"}],
+            max_tokens=1
+        )
+        log("Groq connection warmed up")
+    except Exception as e:
+        log(f"Groq warm-up failed: {e}", level="WARNING")
+
+@app.on_event("startup")
+async def startup_event():
+    """Start background tasks"""
+    # Keep references so the tasks aren't garbage collected
+    background_tasks_running.append(asyncio.create_task(flush_bulk_writes()))
+    background_tasks_running.append(asyncio.create_task(warm_up_groq()))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Flush pending writes and close pooled connections on shutdown"""
+    await commit_pending_writes()
+    await telegram_http.aclose()
+
 @app.get("/", response_model=dict)
 @app.head("/", response_model=dict)
 async def root():
@@ -341,6 +600,10 @@ async def debug_info():
     }
 
 # --- Webhook handler ---
+# Recently processed Telegram update_ids, oldest first
+MAX_SEEN_UPDATES = 10000
+seen_update_ids: "OrderedDict[int, None]" = OrderedDict()
+
 @app.post("/webhook")
 async def telegram_webhook(request: Request, background_tasks: BackgroundTasks):
     """Handle incoming Telegram webhook"""
@@ -349,9 +612,19 @@ async def telegram_webhook(request: Request, background_tasks: BackgroundTasks):
     
     try:
         # Parse the incoming webhook data
-        data = await request.json()
+        data = orjson.loads(await request.body())
         log(f"Received webhook: {data}")
         
+        # Telegram retries deliveries it considers failed - skip ones already handled
+        update_id = data.get("update_id")
+        if update_id is not None:
+            if update_id in seen_update_ids:
+                log(f"Skipping duplicate update {update_id}")
+                return {"ok": True}
+            seen_update_ids[update_id] = None
+            if len(seen_update_ids) > MAX_SEEN_UPDATES:
+                seen_update_ids.popitem(last=False)
+        
         if "message" not in data:
             log("No message in webhook data", level="WARNING")
             return {"ok": True}
@@ -401,13 +674,12 @@ Just chat naturally with me!
                     
                 elif cmd == "/tasks":
                     # Get user tasks
-                    user_data = await get_user_data(user_id)
-                    tasks = user_data.get("tasks", [])
+                    tasks = await get_user_field(user_id, "tasks", [])
                     
                     if not tasks:
                         await send_message(chat_id, "📭 You don't have any tasks yet.")
                     else:
-                        reply = "📋 *Your Tasks*:\n\n"
+                        parts = ["📋 *Your Tasks*:\n\n"]
                         for i, task in enumerate(tasks, 1):
                             status = "✅" if task.get("completed") else "⏳"
                             due_str = ""
@@ -417,26 +689,25 @@ Just chat naturally with me!
                                     due_str += f" at {task['due_time']}"
                                 due_str += ")"
                                 
-                            reply += f"{i}. {status} {task['task']}{due_str}\n"
+                            parts.append(f"{i}. {status} {task['task']}{due_str}\n")
                         
-                        await send_message(chat_id, reply)
+                        await send_message(chat_id, "".join(parts))
                     return {"ok": True}
                     
                 elif cmd == "/notes":
                     # Get user notes
-                    user_data = await get_user_data(user_id)
-                    notes = user_data.get("notes", [])
+                    notes = await get_user_field(user_id, "notes", [])
                     
                     if not notes:
                         await send_message(chat_id, "📭 You don't have any notes yet.")
                     else:
-                        reply = "📝 *Your Notes*:\n\n"
+                        parts = ["📝 *Your Notes*:\n\n"]
                         for i, note in enumerate(notes, 1):
                             created = datetime.fromtimestamp(note.get("timestamp", 0))
                             date_str = created.strftime("%Y-%m-%d")
-                            reply += f"{i}. {note['content']} _{date_str}_\n\n"
+                            parts.append(f"{i}. {note['content']} _{date_str}_\n\n")
                         
-                        await send_message(chat_id, reply)
+                        await send_message(chat_id, "".join(parts))
                     return {"ok": True}
                     
                 elif cmd.startswith("/files"):
@@ -451,13 +722,13 @@ Just chat naturally with me!
                     return {"ok": True}
             
             # Process intent for non-command messages
-            intent_data = await analyze_intent(text)
+            intent_data = await classify_and_extract(text)
             intent = intent_data.get("intent", "general_chat")
             
             # Handle specific intents
             if intent == "task_create":
-                # Extract task details
-                task_info = await extract_task_info(text)
+                # Task details come back with the intent
+                task_info = intent_data.get("task") or {"is_task": False}
                 
                 if task_info.get("is_task") is False:
                     # Not really a task, fall back to general conversation
@@ -473,7 +744,7 @@ Just chat naturally with me!
                         "created_at": time.time()  # Use time.time() instead of Firestore.SERVER_TIMESTAMP
                     }
                     
-                    await add_to_user_array(user_id, "tasks", task_data)
+                    add_to_user_array(user_id, "tasks", task_data)
                     
                     # Craft response
                     due_str = ""
@@ -493,13 +764,12 @@ Just chat naturally with me!
                     "timestamp": time.time(),
                 }
                 
-                await add_to_user_array(user_id, "notes", note_data)
+                add_to_user_array(user_id, "notes", note_data)
                 await send_message(chat_id, "📝 Note saved!")
                 return {"ok": True}
             
-            # Default: process as conversation
-            response = await process_conversation(user_id, text)
-            await send_message(chat_id, response)
+            # Default: process as conversation, streaming the reply into the chat
+            await process_conversation(user_id, text, chat_id=chat_id)
             
         elif "document" in message:
             # Handle document/file uploads
@@ -508,59 +778,32 @@ Just chat naturally with me!
             file_name = doc["file_name"]
             
             # Get file info and download
-            async with httpx.AsyncClient() as client:
-                res = await client.get(f"{API_URL}/getFile?file_id={file_id}")
-                file_path = res.json()["result"]["file_path"]
-                file_url = f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{file_path}"
-                
-                # Download file
-                local_path = f"downloads/{file_id}_{file_name}"
-                os.makedirs("downloads", exist_ok=True)
-                
-                file_data = await client.get(file_url)
-                with open(local_path, "wb") as f:
-                    f.write(file_data.content)
+            res = await telegram_http.get("/getFile", params={"file_id": file_id})
+            file_path = orjson.loads(res.content)["result"]["file_path"]
+            file_url = f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{file_path}"
+            
+            # Download file
+            local_path = f"downloads/{file_id}_{file_name}"
+            os.makedirs("downloads", exist_ok=True)
             
-            # Process file based on type
+            async with telegram_http.stream("GET", file_url) as file_response:
+                async with aiofiles.open(local_path, "wb") as f:
+                    async for chunk in file_response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        await f.write(chunk)
+            
+            # Process file based on type; slow work runs after Telegram gets its response
             if file_name.lower().endswith(('.pdf')):
-                # Process PDF in background
-                await send_message(chat_id, f"📄 Processing document: {file_name}...")
-                response = await process_document(user_id, local_path, file_name)
-                await send_message(chat_id, response)
+                status_id = await send_message(chat_id, f"📄 Processing document: {file_name}...")
+                background_tasks.add_task(process_document_and_reply, user_id, chat_id, status_id, local_path, file_name)
             elif file_name.lower().endswith(('.jpg', '.jpeg', '.png')):
-                # Process image
-                await send_message(chat_id, f"🖼 Processing image: {file_name}...")
-                file_url = await store_file(user_id, local_path, file_name, "images")
-                
-                # Try OCR
-                text = await extract_text_from_image(local_path)
-                if text:
-                    # Store text content for search
-                    img_data = {
-                        "name": file_name,
-                        "text": text,
-                        "url": file_url,
-                        "created_at": time.time()  # Use time.time() instead of Firestore.SERVER_TIMESTAMP
-                    }
-                    
-                    # Add to user's documents collection
-                    loop = asyncio.get_event_loop()
-                    doc_ref = db.collection("users").document(str(user_id)).collection("document_contents")
-                    await loop.run_in_executor(None, lambda: doc_ref.add(img_data))
-                    
-                    await send_message(chat_id, f"🖼 Image saved: {file_name}\n\nText extracted: {text[:100]}...")
-                else:
-                    await send_message(chat_id, f"🖼 Image saved: {file_name}")
+                status_id = await send_message(chat_id, f"🖼 Processing image: {file_name}...")
+                background_tasks.add_task(process_image_and_reply, user_id, chat_id, status_id, local_path, file_name,
+                                          f"🖼 Image saved: {file_name}")
             else:
                 # Generic file
                 file_url = await store_file(user_id, local_path, file_name, "other_files")
                 await send_message(chat_id, f"📁 File saved: {file_name}")
-            
-            # Clean up
-            try:
-                os.remove(local_path)
-            except Exception as e:
-                log(f"Error removing temp file: {e}", level="WARNING")
+                remove_download(local_path)
                 
         elif "photo" in message:
             # Handle photos
@@ -571,48 +814,23 @@ Just chat naturally with me!
             file_name = f"photo_{int(time.time())}.jpg"
             
             # Get file info and download
-            async with httpx.AsyncClient() as client:
-                res = await client.get(f"{API_URL}/getFile?file_id={file_id}")
-                file_path = res.json()["result"]["file_path"]
-                file_url = f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{file_path}"
-                
-                # Download file
-                local_path = f"downloads/{file_id}_{file_name}"
-                os.makedirs("downloads", exist_ok=True)
-                
-                file_data = await client.get(file_url)
-                with open(local_path, "wb") as f:
-                    f.write(file_data.content)
+            res = await telegram_http.get("/getFile", params={"file_id": file_id})
+            file_path = orjson.loads(res.content)["result"]["file_path"]
+            file_url = f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{file_path}"
             
-            # Process image
-            await send_message(chat_id, "🖼 Processing image...")
-            file_url = await store_file(user_id, local_path, file_name, "images")
+            # Download file
+            local_path = f"downloads/{file_id}_{file_name}"
+            os.makedirs("downloads", exist_ok=True)
             
-            # Try OCR
-            text = await extract_text_from_image(local_path)
-            if text:
-                # Store text content for search
-                img_data = {
-                    "name": file_name,
-                    "text": text,
-                    "url": file_url,
-                    "created_at": time.time()  # Use time.time() instead of Firestore.SERVER_TIMESTAMP
-                }
-                
-                # Add to user's documents collection
-                loop = asyncio.get_event_loop()
-                doc_ref = db.collection("users").document(str(user_id)).collection("document_contents")
-                await loop.run_in_executor(None, lambda: doc_ref.add(img_data))
-                
-                await send_message(chat_id, f"🖼 Image saved!\n\nText extracted: {text[:100]}...")
-            else:
-                await send_message(chat_id, "🖼 Image saved!")
-                
-            # Clean up
-            try:
-                os.remove(local_path)
-            except Exception as e:
-                log(f"Error removing temp file: {e}", level="WARNING")
+            async with telegram_http.stream("GET", file_url) as file_response:
+                async with aiofiles.open(local_path, "wb") as f:
+                    async for chunk in file_response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        await f.write(chunk)
+            
+            # Process image after Telegram gets its response
+            status_id = await send_message(chat_id, "🖼 Processing image...")
+            background_tasks.add_task(process_image_and_reply, user_id, chat_id, status_id, local_path, file_name,
+                                      "🖼 Image saved!")
                 
     except Exception as e:
         log(f"Unhandled error in webhook handler: {e}", level="ERROR")
@@ -679,152 +897,245 @@ async def serve_local_file(user_id: str, file_type: str, file_name: str):
         return {"error": str(e)}
 
 # --- AI Processing Functions ---
-async def process_conversation(user_id: str, new_message: str) -> str:
-    """Process user message through LLM and return response"""
-    # Get user session or create new one
-    if user_id not in user_sessions:
-        user_sessions[user_id] = UserSession(user_id)
-        
-    session = user_sessions[user_id]
-    session.last_interaction = time.time()
+async def get_session(user_id: str) -> UserSession:
+    """Get a user session from memory, rehydrating it from Firestore on a miss"""
+    session = user_sessions.get(user_id)
+    if session is not None:
+        user_sessions.move_to_end(user_id)
+        return session
     
-    # Add user message to history
-    user_msg = Message(role="user", content=new_message, timestamp=time.time())
-    session.messages.append(user_msg)
-    
-    # Keep only the last N messages for context window
-    if len(session.messages) > session.context_window:
-        session.messages = session.messages[-session.context_window:]
+    session = UserSession(user_id)
+    try:
+        # Restore the saved conversation so context survives restarts
+        conversation = await get_user_field(user_id, "conversation", [])
+        for msg in conversation[-session.context_window:]:
+            session.add_message(msg["role"], msg["content"], msg.get("timestamp"))
+    except Exception as e:
+        log(f"Error loading conversation for user {user_id}: {e}", level="WARNING")
     
-    # Format conversation for the LLM
-    messages = [{"role": msg.role, "content": msg.content} for msg in session.messages]
+    user_sessions[user_id] = session
+    # Evict the least recently used sessions to bound memory
+    while len(user_sessions) > MAX_SESSIONS:
+        user_sessions.popitem(last=False)
+    return session
+
+async def process_conversation(user_id: str, new_message: str, chat_id: Optional[int] = None) -> str:
+    """Process user message through LLM and return response
     
-    # Add system prompt
-    system_prompt = """You are TeleMind, a helpful personal assistant on Telegram.
-You help users manage tasks, take notes, and handle files.
-Be friendly and concise in your responses.
-Your goal is to help users organize their lives and provide useful information."""
+    When chat_id is given the reply is streamed into that chat as it is
+    generated, so callers must not send the returned text again.
+    """
+    # Get user session or create new one
+    session = await get_session(user_id)
+    session.last_interaction = time.time()
     
-    messages.insert(0, {"role": "system", "content": system_prompt})
+    # Add user message to history
+    session.add_message("user", new_message)
     
+    message_id = None
     try:
         # Call Groq API
-        response = await asyncio.to_thread(
-            groq_client.chat.completions.create,
-            model="llama3-8b-8192",
-            messages=messages,
+        stream = await groq_client.chat.completions.create(
+            model=GROQ_MODEL,
+            messages=session.llm_messages,
             temperature=0.7,
-            max_tokens=800
+            max_tokens=800,
+            stream=True
         )
         
-        # Extract response text
-        assistant_response = response.choices[0].message.content
+        # Collect tokens, editing the Telegram message at most once per interval
+        parts = []
+        last_edit = 0.0
+        last_sent = None
+        async for chunk in stream:
+            token = chunk.choices[0].delta.content
+            if not token:
+                continue
+            parts.append(token)
+            if chat_id is not None and time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                # Partial text may contain unbalanced Markdown, so send it plain
+                last_sent = "".join(parts)
+                if message_id is None:
+                    message_id = await send_message(chat_id, last_sent, parse_mode=None)
+                else:
+                    await edit_message(chat_id, message_id, last_sent, parse_mode=None)
+                last_edit = time.monotonic()
+        
+        assistant_response = "".join(parts)
+        # The final Markdown edit is only needed if the text or its rendering changed
+        if chat_id is not None and (message_id is None or assistant_response != last_sent
+                                    or not MARKDOWN_CHARS.isdisjoint(assistant_response)):
+            await send_or_edit(chat_id, message_id, assistant_response)
         
         # Save assistant response to history
-        assistant_msg = Message(role="assistant", content=assistant_response, timestamp=time.time())
-        session.messages.append(assistant_msg)
+        session.add_message("assistant", assistant_response)
+        
+        # Persist the conversation window so the session can be restored later;
+        # queued with the other writes so the reply doesn't wait on Firestore
+        queue_user_update(user_id, {"conversation": session.conversation()})
         
         return assistant_response
     except Exception as e:
         log(f"Error calling Groq API: {e}", level="ERROR")
-        return "I apologize, but I encountered an issue processing your request. Please try again."
+        error_reply = "I apologize, but I encountered an issue processing your request. Please try again."
+        if chat_id is not None:
+            await send_or_edit(chat_id, message_id, error_reply)
+        return error_reply
+
+# Intent keywords and due-date patterns, compiled once at import
+NOTE_PHRASES = ("save note", "save this", "take note", "note this", "remember this", "remember that")
+TASK_PREFIXES = ("remind me to", "add task:", "add task", "create task:", "create task", "remember to", "don't forget to")
+DATE_RE = re.compile(r'(today|tomorrow|monday|tuesday|wednesday|thursday|friday|saturday|sunday|\d{1,2}/\d{1,2}|\d{1,2}-\d{1,2})')
+TIME_RE = re.compile(r'(\d{1,2}:\d{2}|\d{1,2} (am|pm))')
 
-async def analyze_intent(text: str) -> dict:
-    """Analyze the user's message intent"""
+async def classify_and_extract(text: str) -> dict:
+    """Classify the user's message intent and extract task details in one pass
+    
+    Returns {"intent": ..., "task": {...} or None}.
+    """
     # Simple rule-based intent detection
+    # In a production system, this would use NLP to extract dates, times, etc.
     text_lower = text.lower()
     
     # Check for task creation intent
-    if any(phrase in text_lower for phrase in ["remind me to", "add task", "create task", "remember to", "don't forget to"]):
-        return {"intent": "task_create"}
+    for prefix in TASK_PREFIXES:
+        index = text_lower.find(prefix)
+        if index != -1:
+            # Extract potential date and time patterns
+            date_match = DATE_RE.search(text_lower)
+            time_match = TIME_RE.search(text_lower)
+            
+            return {
+                "intent": "task_create",
+                "task": {
+                    "is_task": True,
+                    "task": text[index + len(prefix):].strip(),
+                    "due_date": date_match.group(1) if date_match else None,
+                    "due_time": time_match.group(1) if time_match else None,
+                    "priority": "medium"  # Default priority
+                }
+            }
     
     # Check for note creation intent
-    if any(phrase in text_lower for phrase in ["save note", "save this", "take note", "note this", "remember this", "remember that"]):
-        return {"intent": "note_create"}
+    if any(phrase in text_lower for phrase in NOTE_PHRASES):
+        return {"intent": "note_create", "task": None}
     
     # Default to general conversation
-    return {"intent": "general_chat"}
+    return {"intent": "general_chat", "task": None}
 
-async def extract_task_info(text: str) -> dict:
-    """Extract task details from user message"""
-    # Simple implementation for now
-    # In a production system, this would use NLP to extract dates, times, etc.
-    
-    text_lower = text.lower()
-    
-    # Check if it's really a task
-    if not any(phrase in text_lower for phrase in ["remind me to", "add task", "create task", "remember to", "don't forget to"]):
-        return {"is_task": False}
-    
-    # Extract potential date patterns
-    date_match = re.search(r'(today|tomorrow|monday|tuesday|wednesday|thursday|friday|saturday|sunday|\d{1,2}/\d{1,2}|\d{1,2}-\d{1,2})', text_lower)
-    date = date_match.group(1) if date_match else None
+def _extract_pdf_text(file_path: str, max_chars: int, max_pages: Optional[int]):
+    """Extract text from a PDF with limits (blocking)
     
-    # Extract potential time patterns
-    time_match = re.search(r'(\d{1,2}:\d{2}|\d{1,2} (am|pm))', text_lower)
-    time = time_match.group(1) if time_match else None
+    Returns (text, total_pages, processed_pages, char_count).
+    """
+    parts = []
+    processed_pages = 0
+    char_count = 0
     
-    # Clean up the task description
-    task = text
-    for prefix in ["remind me to", "add task:", "add task", "create task:", "create task", "remember to", "don't forget to"]:
-        if prefix in text_lower:
-            task = text[text_lower.find(prefix) + len(prefix):].strip()
-            break
+    with fitz.open(file_path) as doc:
+        total_pages = len(doc)
+        log(f"PDF has {total_pages} pages")
+        
+        # Apply page limit if specified
+        if max_pages is None:
+            max_pages = total_pages
+        else:
+            max_pages = min(max_pages, total_pages)
+            
+        # Process pages up to the limit
+        for page_num in range(max_pages):
+            page = doc[page_num]
+            page_text = page.get_text().strip()
+            page_char_count = len(page_text)
+            
+            # Check if we'll exceed the character limit
+            remaining_chars = max_chars - char_count
+            if page_char_count > remaining_chars:
+                # Only add text up to the limit
+                parts.append(page_text[:remaining_chars])
+                char_count += remaining_chars
+                processed_pages += 1
+                log(f"Character limit reached ({max_chars}). Stopped at page {page_num + 1} of {total_pages}.")
+                break
+            else:
+                # Add the whole page text
+                parts.append(page_text + "\n\n")
+                char_count += page_char_count
+                processed_pages += 1
+            
+            # Check if we've hit the character limit
+            if char_count >= max_chars:
+                log(f"Character limit reached ({max_chars}). Stopped at page {page_num + 1} of {total_pages}.")
+                break
+        
+        # Scanned PDFs have no text layer - fall back to OCR of the rendered pages
+        if char_count == 0 and max_pages and 'pytesseract' in globals():
+            log("No text layer found, running OCR on rendered pages")
+            text, ocr_pages = _ocr_pdf(doc, max_pages, max_chars)
+            return text, total_pages, ocr_pages, len(text)
     
-    return {
-        "is_task": True,
-        "task": task,
-        "due_date": date,
-        "due_time": time,
-        "priority": "medium"  # Default priority
-    }
+    return "".join(parts), total_pages, processed_pages, char_count
+
+def remove_download(local_path: str):
+    """Remove a downloaded Telegram file"""
+    try:
+        os.remove(local_path)
+    except Exception as e:
+        log(f"Error removing temp file: {e}", level="WARNING")
+
+async def process_document_and_reply(user_id: str, chat_id: int, status_id: Optional[int], local_path: str, file_name: str):
+    """Process an uploaded PDF, reply to the user and remove the download"""
+    try:
+        response = await process_document(user_id, local_path, file_name)
+        await send_or_edit(chat_id, status_id, response)
+    finally:
+        remove_download(local_path)
+
+async def process_image_and_reply(user_id: str, chat_id: int, status_id: Optional[int], local_path: str, file_name: str,
+                                  saved_msg: str):
+    """Store and OCR an uploaded image, reply to the user and remove the download"""
+    try:
+        # Upload and OCR concurrently
+        file_url, text = await asyncio.gather(
+            store_file(user_id, local_path, file_name, "images"),
+            extract_text_from_image(local_path)
+        )
+        if text:
+            # Store text content for search
+            img_data = {
+                "name": file_name,
+                "text": text,
+                "url": file_url,
+                "created_at": time.time()  # Use time.time() instead of Firestore.SERVER_TIMESTAMP
+            }
+            
+            # Add to user's documents collection
+            add_document_content(user_id, img_data)
+            
+            await send_or_edit(chat_id, status_id, f"{saved_msg}\n\nText extracted: {text[:100]}...")
+        else:
+            await send_or_edit(chat_id, status_id, saved_msg)
+    except Exception as e:
+        log(f"Error processing image: {e}", level="ERROR")
+        await send_or_edit(chat_id, status_id, "Sorry, I encountered an unexpected error. Please try again.")
+    finally:
+        remove_download(local_path)
 
 async def process_document(user_id: str, file_path: str, file_name: str, max_chars: int = 50000, max_pages: int = None) -> str:
     """Process a PDF document and extract text with limits for token management"""
     try:
         log(f"Processing document: {file_name} for user {user_id}")
         
-        # Extract text from PDF with limits
-        text = ""
-        total_pages = 0
-        processed_pages = 0
-        char_count = 0
-        
-        with fitz.open(file_path) as doc:
-            total_pages = len(doc)
-            log(f"PDF has {total_pages} pages")
-            
-            # Apply page limit if specified
-            if max_pages is None:
-                max_pages = total_pages
-            else:
-                max_pages = min(max_pages, total_pages)
-                
-            # Process pages up to the limit
-            for page_num in range(max_pages):
-                page = doc[page_num]
-                page_text = page.get_text().strip()
-                page_char_count = len(page_text)
-                
-                # Check if we'll exceed the character limit
-                remaining_chars = max_chars - char_count
-                if page_char_count > remaining_chars:
-                    # Only add text up to the limit
-                    text += page_text[:remaining_chars]
-                    char_count += remaining_chars
-                    processed_pages += 1
-                    log(f"Character limit reached ({max_chars}). Stopped at page {page_num + 1} of {total_pages}.")
-                    break
-                else:
-                    # Add the whole page text
-                    text += page_text + "\n\n"
-                    char_count += page_char_count
-                    processed_pages += 1
-                
-                # Check if we've hit the character limit
-                if char_count >= max_chars:
-                    log(f"Character limit reached ({max_chars}). Stopped at page {page_num + 1} of {total_pages}.")
-                    break
+        # Extract text off the event loop (PyMuPDF and Tesseract are blocking)
+        # while the file is uploaded to storage
+        extraction, stored = await asyncio.gather(
+            asyncio.to_thread(_extract_pdf_text, file_path, max_chars, max_pages),
+            store_file(user_id, file_path, file_name, "documents"),
+            return_exceptions=True
+        )
+        if isinstance(extraction, Exception):
+            raise extraction
+        text, total_pages, processed_pages, char_count = extraction
         
         # Store the extracted text in Firestore
         if text:
@@ -840,29 +1151,21 @@ async def process_document(user_id: str, file_path: str, file_name: str, max_cha
                 "created_at": time.time()  # Use time.time() instead of Firestore.SERVER_TIMESTAMP
             }
             
-            # Try to store file in Firebase Storage
+            # Check the result of storing the file in Firebase Storage
             storage_msg = ""
-            try:
-                file_url = await store_file(user_id, file_path, file_name, "documents")
-                if file_url and file_url != file_path:  # Check if we got a real URL back
-                    pdf_data["url"] = file_url
-                    log(f"File stored at URL: {file_url}")
-                else:
-                    storage_msg = "\n\n⚠️ Note: Document couldn't be stored in cloud storage, but text was extracted."
-                    log("Storage returned empty or local URL - storage may not be configured properly", level="WARNING")
-            except Exception as storage_err:
+            if isinstance(stored, Exception):
                 storage_msg = "\n\n⚠️ Note: Document couldn't be stored in cloud storage, but text was extracted."
-                log(f"Error storing file: {storage_err}", level="ERROR")
+                log(f"Error storing file: {stored}", level="ERROR")
+            elif stored and stored != file_path:  # Check if we got a real URL back
+                pdf_data["url"] = stored
+                log(f"File stored at URL: {stored}")
+            else:
+                storage_msg = "\n\n⚠️ Note: Document couldn't be stored in cloud storage, but text was extracted."
+                log("Storage returned empty or local URL - storage may not be configured properly", level="WARNING")
             
-            try:
-                # Add to user's documents collection
-                loop = asyncio.get_event_loop()
-                doc_ref = db.collection("users").document(str(user_id)).collection("document_contents")
-                await loop.run_in_executor(None, lambda: doc_ref.add(pdf_data))
-                log("Document text saved to Firestore")
-            except Exception as db_err:
-                log(f"Error saving document text to Firestore: {db_err}", level="ERROR")
-                storage_msg += "\n⚠️ Document text couldn't be saved to database."
+            # Add to user's documents collection (write failures are logged when committed)
+            add_document_content(user_id, pdf_data)
+            log("Document text queued for Firestore")
             
             # Prepare response message
             truncated_msg = ""
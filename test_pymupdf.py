@@ -4,127 +4,346 @@ import sys
 import tempfile
 import requests
 import io
+import functools
+import hashlib
+import re
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import urlparse
 
-def extract_text_from_pdf(pdf_path, max_chars=10000, max_pages=None, chars_per_page=None, remote_url=None):
-    """
-    Extract text from a PDF file using PyMuPDF with limits for token management.
+# Pages handed to a worker process at a time; small enough that the remaining
+# batches can be cancelled once max_chars is reached
+PAGES_PER_TASK = 8
+
+# Flattens line breaks in per-page previews
+PREVIEW_TRANSLATION = str.maketrans({'\n': ' ', '\r': ' '})
+
+# Finds where stripped page text starts (or continues) without copying the page
+NON_SPACE_RE = re.compile(r'\S')
+
+# Read size when streaming remote PDFs to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Buffer for the CLI's output file, so streamed pages are flushed in large writes
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+# Shared session so repeated downloads from the same host reuse connections
+http_session = requests.Session()
+
+# Pages kept in the on-disk text cache; least recently used are removed first
+PAGE_CACHE_MAX_ENTRIES = 500
+
+# Bytes hashed (with the file size) to identify a PDF in the page cache
+PAGE_CACHE_HASH_BYTES = 1024 * 1024
+
+# Newer PyMuPDF raises its own FileNotFoundError (a RuntimeError) for missing files
+FILE_NOT_FOUND_ERRORS = (FileNotFoundError, getattr(fitz, 'FileNotFoundError', FileNotFoundError))
+
+def _page_text(page, chars_per_page, sort=False):
+    """Get a page's text, cut to chars_per_page before any further processing"""
+    # Plain text without reading-order sorting is enough for LLM ingestion
+    text = page.get_text("text", sort=sort)
+    if chars_per_page is not None:
+        text = text[:chars_per_page]
+    return text
+
+def _doc_cache_key(pdf_path):
+    """Identify a PDF by a hash of its size and leading bytes"""
+    digest = hashlib.sha1(str(os.path.getsize(pdf_path)).encode())
+    with open(pdf_path, 'rb') as f:
+        digest.update(f.read(PAGE_CACHE_HASH_BYTES))
+    return digest.hexdigest()
+
+def _cached_page_text(get_page, page_num, chars_per_page, sort, cache_dir, doc_key):
+    """Get a page's text from the on-disk cache, extracting and storing it on a miss"""
+    if cache_dir is None:
+        return _page_text(get_page(page_num), chars_per_page, sort)
     
-    Args:
-        pdf_path: Path to the PDF file (local) or None if remote_url is provided
-        max_chars: Maximum total characters to extract (default: 10000)
-        max_pages: Maximum number of pages to process (default: all pages)
-        chars_per_page: Maximum characters per page (default: no limit per page)
-        remote_url: URL to the PDF file (for Firebase Storage or other remote files)
-    """
-    temp_file = None
+    # Sorted and unsorted text are cached separately
+    sort_suffix = "-sorted" if sort else ""
+    cache_file = os.path.join(cache_dir, f"{doc_key}-{page_num}{sort_suffix}.txt")
     try:
-        # Handle remote URL if provided
-        if remote_url:
-            print(f"Downloading PDF from: {remote_url}")
-            response = requests.get(remote_url, stream=True)
-            if response.status_code == 200:
-                # For memory efficiency, create a temporary file
-                temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-                temp_file.write(response.content)
-                temp_file.close()
-                pdf_path = temp_file.name
-                print(f"Downloaded to temporary file: {pdf_path}")
-            else:
-                print(f"Error downloading file: HTTP {response.status_code}")
-                return False
-        
-        # Check if file exists (for local files)
-        if not remote_url and not os.path.exists(pdf_path):
-            print(f"Error: File not found at {pdf_path}")
-            return False
-
-        # Open the PDF
-        print(f"Opening PDF: {pdf_path}")
-        doc = fitz.open(pdf_path)
-        
-        # Get document info
+        with open(cache_file, encoding='utf-8') as f:
+            text = f.read()
+        # Mark the entry as recently used for pruning
+        os.utime(cache_file)
+    except FileNotFoundError:
+        # Cache the whole page so any chars_per_page can be served from it
+        text = _page_text(get_page(page_num), None, sort)
+        # Write under a temporary name so other processes never read a partial entry
+        temp_cache_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(temp_cache_file, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temp_cache_file, cache_file)
+    
+    if chars_per_page is not None:
+        text = text[:chars_per_page]
+    return text
+
+def _prune_page_cache(cache_dir):
+    """Remove the least recently used cache entries beyond PAGE_CACHE_MAX_ENTRIES"""
+    entries = [entry for entry in os.scandir(cache_dir) if entry.name.endswith('.txt')]
+    if len(entries) <= PAGE_CACHE_MAX_ENTRIES:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in entries[:len(entries) - PAGE_CACHE_MAX_ENTRIES]:
+        try:
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+
+def _count_tokens(parts):
+    """Count tokens exactly with tiktoken, or return None if it isn't installed"""
+    try:
+        # Imported here so startup doesn't pay for it unless exact counts are wanted
+        import tiktoken
+    except ImportError:
+        return None
+    encoding = tiktoken.get_encoding("cl100k_base")
+    # One batched call into the encoder rather than one per page
+    return sum(map(len, encoding.encode_ordinary_batch(parts)))
+
+@functools.lru_cache(maxsize=1)
+def _worker_doc(pdf_path):
+    """Open the PDF once per worker process rather than once per batch"""
+    return fitz.open(pdf_path)
+
+def _extract_range(pdf_path, start, end, chars_per_page, sort, cache_dir, doc_key):
+    """Extract the text of pages [start, end) in a worker process"""
+    get_page = _worker_doc(pdf_path).load_page
+    return [_cached_page_text(get_page, page_num, chars_per_page, sort, cache_dir, doc_key)
+            for page_num in range(start, end)]
+
+def _iter_page_texts(pdf_path, doc, max_pages, workers, chars_per_page, sort, cache_dir, doc_key):
+    """Yield the text of the first max_pages pages in order"""
+    # A single batch gains nothing from a worker process
+    if workers <= 1 or max_pages <= PAGES_PER_TASK:
+        get_page = doc.load_page
+        for page_num in range(max_pages):
+            yield _cached_page_text(get_page, page_num, chars_per_page, sort, cache_dir, doc_key)
+        return
+    
+    # Each worker reopens the PDF by path, as PyMuPDF documents can't be shared
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_extract_range, pdf_path, start, min(start + PAGES_PER_TASK, max_pages), chars_per_page,
+                            sort, cache_dir, doc_key)
+            for start in range(0, max_pages, PAGES_PER_TASK)
+        ]
+        try:
+            for future in futures:
+                yield from future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+def _extract_from_doc(doc, max_chars, max_pages, chars_per_page, workers, verbose, out, cache_dir=None, sort=False,
+                      exact_tokens=False):
+    """Extract text with limits from an open PyMuPDF document"""
+    total_pages = len(doc)
+    
+    # Print document info
+    if verbose:
         print(f"\nDocument Information:")
-        total_pages = len(doc)
         print(f"Number of pages: {total_pages}")
         
-        if doc.metadata:
-            print(f"Title: {doc.metadata.get('title', 'N/A')}")
-            print(f"Author: {doc.metadata.get('author', 'N/A')}")
-            print(f"Subject: {doc.metadata.get('subject', 'N/A')}")
-            print(f"Producer: {doc.metadata.get('producer', 'N/A')}")
+        metadata = doc.metadata
+        if metadata:
+            print(f"Title: {metadata.get('title', 'N/A')}\n"
+                  f"Author: {metadata.get('author', 'N/A')}\n"
+                  f"Subject: {metadata.get('subject', 'N/A')}\n"
+                  f"Producer: {metadata.get('producer', 'N/A')}")
+    
+    # Apply page limit if specified
+    if max_pages is None:
+        max_pages = total_pages
+    else:
+        max_pages = min(max_pages, total_pages)
         
-        # Apply page limit if specified
-        if max_pages is None:
-            max_pages = total_pages
-        else:
-            max_pages = min(max_pages, total_pages)
-            
+    if verbose:
         print(f"Processing up to {max_pages} pages with {max_chars} character limit")
-            
-        # Extract text from each page with limits
-        print("\nExtracting text from pages...")
-        extracted_text = ""
-        char_count = 0
-        processed_pages = 0
+    
+    # Don't read (or start workers for) any page if there is no character budget
+    if max_chars <= 0:
+        max_pages = 0
+    
+    # Worker processes are opt-in: with a typical character budget the first
+    # pages are enough, and a pool would keep extracting batches past the limit
+    if workers is None:
+        workers = 1
+    # Workers reopen the file by path, so in-memory documents are read here
+    if not doc.name:
+        workers = 1
+    
+    # Cached pages are keyed by file contents, so in-memory documents aren't cached
+    doc_key = None
+    if cache_dir is not None and doc.name:
+        os.makedirs(cache_dir, exist_ok=True)
+        doc_key = _doc_cache_key(doc.name)
+    else:
+        cache_dir = None
         
-        for page_num in range(max_pages):
-            page = doc[page_num]
-            text = page.get_text()
-            
-            # Apply per-page character limit if specified
-            if chars_per_page is not None:
-                text = text[:chars_per_page]
-                
-            # Print page preview
+    # Extract text from each page with limits
+    if verbose:
+        print("\nExtracting text from pages...")
+    # Write straight to out when given, otherwise collect pages to join
+    extracted_parts = []
+    write = out.write if out is not None else extracted_parts.append
+    # Exact token counts need the text even when it's streamed to out
+    count_tokens = verbose and exact_tokens
+    if count_tokens and out is not None:
+        def write(text, write_out=out.write):
+            write_out(text)
+            extracted_parts.append(text)
+    char_count = 0
+    processed_pages = 0
+    
+    # Per-page character limit is applied as each page is read, so workers
+    # only send back the part that will be used
+    page_texts = _iter_page_texts(doc.name, doc, max_pages, workers, chars_per_page, sort, cache_dir, doc_key)
+    for page_num, text in enumerate(page_texts):
+        # Print page preview
+        if verbose:
             print(f"\n--- Page {page_num + 1} ---")
-            preview = text[:150].replace('\n', ' ').strip()
+            preview = text[:150].translate(PREVIEW_TRANSLATION).strip()
             if len(text) > 150:
                 preview += "..."
             print(preview)
-            
-            # Add text to overall extraction
-            page_text = text.strip()
-            page_char_count = len(page_text)
-            
-            # Check if we'll exceed the character limit
-            remaining_chars = max_chars - char_count
-            if page_char_count > remaining_chars:
-                # Only add text up to the limit
-                extracted_text += page_text[:remaining_chars]
-                char_count += remaining_chars
-                processed_pages += 1
-                print(f"Character limit reached ({max_chars}). Stopped at page {page_num + 1}.")
-                break
-            else:
-                # Add the whole page text
-                extracted_text += page_text + "\n\n"
-                char_count += page_char_count
-                processed_pages += 1
-            
-            # Check if we've hit the character limit
-            if char_count >= max_chars:
+        
+        # Add text to overall extraction, only slicing out the part within the
+        # limit rather than stripping the whole page first
+        remaining_chars = max_chars - char_count
+        first_char = NON_SPACE_RE.search(text)
+        start = first_char.start() if first_char else len(text)
+        limit = start + remaining_chars
+        
+        # Check if we'll exceed the character limit (any text left past it)
+        if NON_SPACE_RE.search(text, limit):
+            # Only add text up to the limit
+            write(text[start:limit])
+            char_count += remaining_chars
+            processed_pages += 1
+            if verbose:
                 print(f"Character limit reached ({max_chars}). Stopped at page {page_num + 1}.")
-                break
+            break
+        else:
+            # Add the whole page text
+            page_text = text[start:limit].rstrip()
+            write(page_text + "\n\n")
+            char_count += len(page_text)
+            processed_pages += 1
         
+        # Check if we've hit the character limit
+        if char_count >= max_chars:
+            if verbose:
+                print(f"Character limit reached ({max_chars}). Stopped at page {page_num + 1}.")
+            break
+    
+    # Stop any worker batches that are no longer needed
+    page_texts.close()
+    
+    if cache_dir is not None:
+        _prune_page_cache(cache_dir)
+    
+    if verbose:
         print(f"\nText extraction complete! Processed {processed_pages} of {total_pages} pages.")
         print(f"Extracted {char_count} characters (limit: {max_chars})")
         
-        # Calculate approximate tokens (rough estimate: ~4 chars per token for English text)
-        estimated_tokens = char_count // 4
-        print(f"Estimated tokens: ~{estimated_tokens}")
+        token_count = _count_tokens(extracted_parts) if count_tokens else None
+        if token_count is not None:
+            print(f"Tokens (cl100k_base): {token_count}")
+        else:
+            if count_tokens:
+                print("tiktoken is not installed, estimating tokens instead")
+            # Calculate approximate tokens (rough estimate: ~4 chars per token for English text)
+            estimated_tokens = char_count // 4
+            print(f"Estimated tokens: ~{estimated_tokens}")
+    
+    if out is not None:
+        return char_count
+    return "".join(extracted_parts)
+
+def extract_text_from_pdf(pdf_path, max_chars=10000, max_pages=None, chars_per_page=None, remote_url=None, workers=1,
+                          verbose=False, out=None, cache_dir=None, sort=False, exact_tokens=False):
+    """
+    Extract text from a PDF file using PyMuPDF with limits for token management.
+    
+    Args:
+        pdf_path: Path to the PDF file (local), an already open fitz.Document,
+            or None if remote_url is provided
+        max_chars: Maximum total characters to extract (default: 10000)
+        max_pages: Maximum number of pages to process (default: all pages)
+        chars_per_page: Maximum characters per page (default: no limit per page)
+        remote_url: URL to the PDF file (for Firebase Storage or other remote files)
+        workers: Worker processes for page extraction (default: 1, no pool); worth
+            raising only when max_chars is large enough to span many pages
+        verbose: Print document info and per-page previews (errors are always printed)
+        out: Optional text stream to write extracted text to as each page is read;
+            the character count is returned instead of the text
+        cache_dir: Optional directory to cache per-page text in, so repeated runs
+            on the same PDF skip PyMuPDF for pages already seen
+        sort: Sort text into reading order (default: off, which is faster and
+            enough for bulk or LLM ingestion; turn on for layout fidelity)
+        exact_tokens: Report an exact cl100k_base token count with tiktoken instead
+            of the ~4 chars per token estimate (verbose only; needs tiktoken)
+    """
+    temp_file = None
+    try:
+        # Reuse a document the caller already has open
+        if isinstance(pdf_path, fitz.Document):
+            return _extract_from_doc(pdf_path, max_chars, max_pages, chars_per_page, workers, verbose, out, cache_dir, sort,
+                                     exact_tokens)
+        
+        # Handle remote URL if provided
+        if remote_url:
+            if verbose:
+                print(f"Downloading PDF from: {remote_url}")
+            # identity encoding so chunks are written as-is rather than inflated in memory
+            with http_session.get(remote_url, stream=True, headers={"Accept-Encoding": "identity"}) as response:
+                if response.status_code == 200:
+                    # Stream into a temporary file so memory use doesn't grow with the PDF size
+                    # (closed by the with block, removed in finally once extraction is done)
+                    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
+                        # Reserve the full size up front when the server reports it
+                        content_length = int(response.headers.get('Content-Length', 0))
+                        if content_length > 0 and hasattr(os, 'posix_fallocate'):
+                            try:
+                                os.posix_fallocate(temp_file.fileno(), 0, content_length)
+                            except OSError:
+                                # Not supported by every filesystem; the writes below still work
+                                pass
+                        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            temp_file.write(chunk)
+                        # Drop any reserved space past what was actually received
+                        temp_file.truncate()
+                    pdf_path = temp_file.name
+                    if verbose:
+                        print(f"Downloaded to temporary file: {pdf_path}")
+                else:
+                    print(f"Error downloading file: HTTP {response.status_code}")
+                    return False
         
-        return extracted_text
+        # Open the PDF; a missing file is reported by fitz.open rather than checked first
+        if verbose:
+            print(f"Opening PDF: {pdf_path}")
+        with fitz.open(pdf_path) as doc:
+            return _extract_from_doc(doc, max_chars, max_pages, chars_per_page, workers, verbose, out, cache_dir, sort,
+                                     exact_tokens)
     
+    except FILE_NOT_FOUND_ERRORS:
+        print(f"Error: File not found at {pdf_path}")
+        return False
     except Exception as e:
         print(f"Error extracting text from PDF: {e}")
         return False
     finally:
         # Clean up the temporary file if it was created
-        if temp_file and os.path.exists(temp_file.name):
+        if temp_file:
             try:
                 os.unlink(temp_file.name)
-                print(f"Removed temporary file: {temp_file.name}")
+                if verbose:
+                    print(f"Removed temporary file: {temp_file.name}")
+            except FileNotFoundError:
+                pass
             except Exception as e:
                 print(f"Warning: Could not remove temporary file: {e}")
 
@@ -142,17 +361,26 @@ if __name__ == "__main__":
                         help='Maximum characters per page (default: no limit)')
     parser.add_argument('--url', action='store_true',
                         help='Treat pdf_path as a URL rather than a local file path')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes for page extraction (default: 1; use more for large --max-chars)')
+    parser.add_argument('--cache-dir',
+                        help='Directory to cache extracted page text in (default: no cache)')
+    parser.add_argument('--sort', action='store_true',
+                        help='Sort page text into reading order (slower)')
+    parser.add_argument('--exact-tokens', action='store_true',
+                        help='Count tokens exactly with tiktoken instead of estimating')
     
     args = parser.parse_args()
     pdf_path = args.pdf_path
     
     # If no PDF path was provided via arguments
     if not pdf_path:
-        # Look for any PDF in the current directory
-        pdfs = [f for f in os.listdir('.') if f.lower().endswith('.pdf')]
+        # Use the first PDF found in the current directory
+        with os.scandir('.') as entries:
+            pdf_path = next((entry.name for entry in entries
+                             if entry.name.endswith(('.pdf', '.PDF')) and entry.is_file()), None)
         
-        if pdfs:
-            pdf_path = pdfs[0]
+        if pdf_path:
             print(f"No PDF path provided, using: {pdf_path}")
         else:
             pdf_path = input("Please enter the path to a PDF file: ")
@@ -161,24 +389,43 @@ if __name__ == "__main__":
     remote_url = pdf_path if args.url else None
     local_path = None if args.url else pdf_path
     
-    text = extract_text_from_pdf(
-        local_path, 
-        max_chars=args.max_chars, 
-        max_pages=args.max_pages,
-        chars_per_page=args.chars_per_page,
-        remote_url=remote_url
-    )
-    
-    # Save extracted text to a file for review (optional)
-    if text:
-        if args.url:
-            # For URLs, extract the filename from the URL or use a default name
-            url_path = urlparse(pdf_path).path
-            filename = os.path.basename(url_path) if url_path else "remote_file.pdf"
-            output_file = filename.replace('.pdf', '_extracted.txt')
-        else:
-            output_file = pdf_path.replace('.pdf', '_extracted.txt')
-            
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(text)
-        print(f"\nExtracted text saved to: {output_file}")
+    # Pick the output file up front so pages are written as they are extracted
+    if args.url:
+        # For URLs, extract the filename from the URL or use a default name
+        url_path = urlparse(pdf_path).path
+        filename = os.path.basename(url_path) if url_path else "remote_file.pdf"
+        output_file = filename.replace('.pdf', '_extracted.txt')
+    else:
+        output_file = pdf_path.replace('.pdf', '_extracted.txt')
+    if output_file == local_path:
+        # Never truncate the input when it has no .pdf extension
+        output_file += "_extracted.txt"
+    
+    # Pages are written to a partial file that only replaces output_file once
+    # something was extracted, so a failed run leaves an earlier output intact
+    partial_file = f"{output_file}.part"
+    try:
+        with open(partial_file, 'w', encoding='utf-8', buffering=OUTPUT_BUFFER_SIZE) as f:
+            char_count = extract_text_from_pdf(
+                local_path, 
+                max_chars=args.max_chars, 
+                max_pages=args.max_pages,
+                chars_per_page=args.chars_per_page,
+                remote_url=remote_url,
+                workers=args.workers,
+                cache_dir=args.cache_dir,
+                sort=args.sort,
+                exact_tokens=args.exact_tokens,
+                verbose=True,
+                out=f
+            )
+        
+        # Keep the extracted text file for review only if something was written
+        if char_count:
+            os.replace(partial_file, output_file)
+            print(f"\nExtracted text saved to: {output_file}")
+    finally:
+        try:
+            os.remove(partial_file)
+        except FileNotFoundError:
+            pass